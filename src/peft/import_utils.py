@@ -101,6 +101,26 @@ def is_hqq_available():
     return importlib.util.find_spec("hqq") is not None
 
 
+@lru_cache
+def is_scipy_available() -> bool:
+    return importlib.util.find_spec("scipy") is not None
+
+
+@lru_cache
+def is_simsimd_available() -> bool:
+    return importlib.util.find_spec("simsimd") is not None
+
+
+@lru_cache
+def is_numba_available() -> bool:
+    return importlib.util.find_spec("numba") is not None
+
+
+@lru_cache
+def is_triton_available() -> bool:
+    return importlib.util.find_spec("triton") is not None
+
+
 @lru_cache
 def is_torchao_available():
     if importlib.util.find_spec("torchao") is None:
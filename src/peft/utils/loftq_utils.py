@@ -24,7 +24,7 @@ from typing import Callable, Optional, Union
 import torch
 from huggingface_hub import snapshot_download
 from huggingface_hub.errors import HFValidationError
-from safetensors import SafetensorError, safe_open
+from safetensors import safe_open
 from transformers.utils import cached_file
 from transformers.utils.hub import get_checkpoint_shard_files
 
@@ -268,10 +268,10 @@ class _SafetensorLoader:
     """
 
     def __init__(self, peft_model_or_model_id, model_path=None, local_files_only=True):
+        base_model_prefix = None
         if model_path is None:
             if isinstance(peft_model_or_model_id, str):
                 name_or_path = peft_model_or_model_id
-                base_model_prefix = None
             else:
                 name_or_path = peft_model_or_model_id
                 base_model_prefix = getattr(peft_model_or_model_id.get_base_model(), "base_model_prefix", None)
@@ -295,6 +295,8 @@ class _SafetensorLoader:
         self.prefix = "base_model.model."
         self.is_sharded = False
         self.weight_map = None
+        # cache of open safetensors handles, so that repeated get_tensor calls don't reopen (and remap) the file
+        self._open_handles = {}
 
         if not os.path.exists(model_path):
             # check if the file is sharded
@@ -312,25 +314,37 @@ class _SafetensorLoader:
             # maps from 'model-X-of-Y.safetensors' to full file path
             file_map = {k.rpartition(os.path.sep)[-1]: k for k in resolved_archive_file}
             self.weight_map = {k: file_map[v] for k, v in sharded_metadata["weight_map"].items()}
-
-    def get_tensor(self, name):
-        if not self.is_sharded:
-            file_path = self.model_path
         else:
-            file_path = self.weight_map[name]
+            # give single-file checkpoints a weight map too, so both layouts can be treated uniformly
+            self.weight_map = dict.fromkeys(self._open_file(model_path).keys(), model_path)
+
+    def _open_file(self, file_path):
+        handle = self._open_handles.get(file_path)
+        if handle is None:
+            if hasattr(os, "posix_fadvise"):
+                # ask the kernel to start reading the file into the page cache; unlike the sequential hint, which is
+                # tied to the (immediately closed) fd, WILLNEED populates the shared cache that the mmap reads from
+                fd = os.open(file_path, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            handle = safe_open(file_path, framework="pt", device="cpu")
+            self._open_handles[file_path] = handle
+        return handle
 
-        with safe_open(file_path, framework="pt", device="cpu") as f:
-            try:
-                tensor = f.get_tensor(name)
-            except SafetensorError as exc:
-                # no matching key found, we probably need to remove the base model prefix
-                if self.base_model_prefix:
-                    # remove 1 extra character for "."
-                    name = name[len(self.base_model_prefix) + 1 :]
-                    tensor = f.get_tensor(name)
-                else:
-                    raise exc
-        return tensor
+    def get_tensor(self, name):
+        file_path = self.weight_map.get(name)
+        if file_path is None and self.base_model_prefix:
+            # no matching key found, we probably need to remove the base model prefix (+ 1 character for the ".")
+            stripped = name[len(self.base_model_prefix) + 1 :]
+            file_path = self.weight_map.get(stripped)
+            if file_path is not None:
+                name = stripped
+        if file_path is None:
+            raise KeyError(f"Could not find tensor '{name}' in the checkpoint at {self.model_path}")
+
+        return self._open_file(file_path).get_tensor(name)
 
 
 @torch.no_grad()
@@ -14,17 +14,20 @@
 # Reference paper: https://arxiv.org/abs/2405.16833
 
 
-import copy
+import concurrent.futures
 import os
+import re
 from dataclasses import dataclass, field
 from typing import Literal
 
+import numpy as np
 import torch
 from safetensors import safe_open
 from safetensors.torch import save_file
 
 import peft
 from peft import PeftConfig
+from peft.import_utils import is_numba_available, is_scipy_available, is_simsimd_available, is_triton_available
 
 from .loftq_utils import _SafetensorLoader as SafetensorLoader
 
@@ -65,6 +68,15 @@ class SafeLoraConfig:
         save_weights (`bool`):
             Whether to override the original LoRA file with SafeLoRA weights.
 
+        offload_v (`bool`):
+            Whether to offload the projection matrices to CPU between computing and applying them. This lowers the
+            device memory usage at the cost of an extra round-trip transfer per layer.
+
+        quantize_projection (`bool`):
+            Whether to run the projection matmul with int8-quantized operands. This roughly doubles the throughput of
+            the largest GEMM on hardware with int8 support, at the cost of a small quantization error in the projected
+            weights.
+
         local_files_only (`bool`):
             Set this value to True to work only with local files (no downloads).
 
@@ -109,6 +121,17 @@ class SafeLoraConfig:
         default=True,
         metadata={"help": "Whether to override the original LoRA file with SafeLoRA weights."},
     )
+
+    offload_v: bool = field(
+        default=False,
+        metadata={"help": "Whether to offload the projection matrices to CPU to lower the device memory usage."},
+    )
+
+    quantize_projection: bool = field(
+        default=False,
+        metadata={"help": "Whether to run the projection matmul with int8-quantized operands."},
+    )
+
     local_files_only: bool = field(
         default=False,
         metadata={"help": "Set this value to True to work only with local files (no downloads)."},
@@ -138,53 +161,261 @@ def get_aligned_matrix(base_model_path, aligned_model_path, peft_config, safelor
     sl_align = SafetensorLoader(aligned_model_path, local_files_only=safelora_config.local_files_only)
     sl_base = SafetensorLoader(base_model_path, local_files_only=safelora_config.local_files_only)
 
-    base_model_parameters = [
-        name for name in sl_base.weight_map.keys() if any(v in name for v in list(peft_config.target_modules))
-    ]
-
-    align_model_parameters = [
-        name for name in sl_align.weight_map.keys() if any(v in name for v in list(peft_config.target_modules))
-    ]
-    safety_vector = []
-    for name_base, name_align in zip(base_model_parameters, align_model_parameters):
-        if sl_base.get_tensor(name_base).shape != sl_align.get_tensor(name_align).shape:
-            raise ValueError(
-                "The dimensions of the base model's weight should be the same with the aligned model's weight."
-            )
-        if (sl_base.get_tensor(name_base) == sl_align.get_tensor(name_align)).all():
-            raise ValueError("The weights of the base Model and the aligned Model should be different.")
-        vec = sl_base.get_tensor(name_base) - sl_align.get_tensor(name_align)
-        vec = vec.to(dtype=safelora_config.dtype, device=safelora_config.device)
-        vec = torch.mm(vec, vec.t()) / torch.norm(vec)
-        safety_vector.append(vec.detach().cpu())
+    if not peft_config.target_modules:
+        # an empty alternation would match every weight name instead of none
+        raise ValueError("There is no target module in the peft config, please set target_modules.")
+
+    # one compiled alternation instead of a Python-level scan of every target module against every weight name
+    pattern = re.compile("|".join(re.escape(v) for v in peft_config.target_modules))
+    base_model_parameters = [name for name in sl_base.weight_map if pattern.search(name)]
+    align_model_parameters = [name for name in sl_align.weight_map if pattern.search(name)]
+    # Group the layers by weight shape so that each group can be projected with a single batched matmul (and a single
+    # transfer to/from the device) instead of one small matmul per layer. The tensors of the next layer are prefetched
+    # on a worker thread so that disk I/O overlaps with the diff computation of the current layer.
+    pairs = list(zip(base_model_parameters, align_model_parameters))
+    # read the tensors shard by shard so that sharded models are streamed sequentially instead of hopping between
+    # files; the original layer order is restored via the index carried alongside each diff
+    order = sorted(
+        range(len(pairs)), key=lambda i: (sl_base.weight_map[pairs[i][0]], sl_align.weight_map[pairs[i][1]])
+    )
+    groups: dict[tuple[int, ...], list[tuple[int, torch.Tensor]]] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+
+        def fetch(pair):
+            name_base, name_align = pair
+            return sl_base.get_tensor(name_base), sl_align.get_tensor(name_align)
+
+        future = executor.submit(fetch, pairs[order[0]]) if order else None
+        for pos, idx in enumerate(order):
+            tensor_base, tensor_align = future.result()
+            if pos + 1 < len(order):
+                future = executor.submit(fetch, pairs[order[pos + 1]])
+            _collect_diff(groups, idx, tensor_base, tensor_align)
+
+    safety_vector = [None] * len(base_model_parameters)
+    is_cuda = torch.device(safelora_config.device).type == "cuda"
+    scratch = None  # pinned staging buffer, reused (and grown as needed) across the shape groups
+    for diffs in groups.values():
+        shape = diffs[0][1].shape
+        dtype = diffs[0][1].dtype
+        if is_cuda:
+            # stage the batch in pinned memory so the host-to-device copy runs as DMA, without allocating a fresh
+            # pinned buffer per group
+            needed = len(diffs) * diffs[0][1].numel()
+            if scratch is None or scratch.numel() < needed or scratch.dtype != dtype:
+                scratch = torch.empty(needed, dtype=dtype, pin_memory=True)
+            batch = scratch[:needed].view(len(diffs), *shape)
+            for i, (_, diff) in enumerate(diffs):
+                batch[i].copy_(diff)
+        else:
+            batch = torch.stack([diff for _, diff in diffs])
+        batch = batch.to(device=safelora_config.device).to(safelora_config.dtype)
+        norms = torch.linalg.norm(batch.flatten(start_dim=1), dim=1)
+        if not is_cuda and batch.dtype in (torch.float32, torch.float64) and is_scipy_available():
+            # D @ D.T is symmetric, so BLAS' syrk can compute it with half the FLOPs of a full GEMM; torch does not
+            # expose syrk, hence the detour via scipy. On CUDA the bmm below is kept since cuBLAS syrk is not exposed.
+            from scipy.linalg import blas
+
+            syrk = blas.ssyrk if batch.dtype == torch.float32 else blas.dsyrk
+            outs = []
+            for i in range(batch.size(0)):
+                upper = syrk(1.0, batch[i].numpy())
+                outs.append(torch.from_numpy(np.triu(upper) + np.triu(upper, 1).T))
+            vecs = torch.stack(outs) / norms.view(-1, 1, 1)
+        else:
+            vecs = torch.bmm(batch, batch.transpose(1, 2)) / norms.view(-1, 1, 1)
+        # keep the projection matrices resident on the device by default; project_weights would otherwise pay a full
+        # host round-trip per layer just to move them back
+        vecs = vecs.detach().cpu() if safelora_config.offload_v else vecs.detach()
+        for (idx, _), vec in zip(diffs, vecs):
+            safety_vector[idx] = vec
     return safety_vector
 
 
-def project_weights(safelora_config, peft_weights, v):
-    ori_peft_weights = copy.deepcopy(peft_weights)
+def _collect_diff(groups, idx, tensor_base, tensor_align):
+    if tensor_base.shape != tensor_align.shape:
+        raise ValueError(
+            "The dimensions of the base model's weight should be the same with the aligned model's weight."
+        )
+    if torch.equal(tensor_base, tensor_align):
+        raise ValueError("The weights of the base Model and the aligned Model should be different.")
+    groups.setdefault(tuple(tensor_base.shape), []).append((idx, tensor_base - tensor_align))
+
+
+def _int8_mm(P, B):
+    """Compute P @ B through torch._int_mm with a per-tensor scale for P and a per-column scale for B."""
+    scale_P = P.abs().amax() / 127.0
+    scale_B = (B.abs().amax(dim=0) / 127.0).clamp_min(1e-12)
+    P_i8 = torch.round(P / scale_P).to(torch.int8)
+    B_i8 = torch.round(B / scale_B).to(torch.int8)
+    return torch._int_mm(P_i8, B_i8).to(P.dtype) * scale_P * scale_B
+
+
+_triton_cosine_kernel = None
+
+
+def _get_triton_cosine_kernel():
+    # compiled lazily so that importing this module never requires triton
+    global _triton_cosine_kernel
+    if _triton_cosine_kernel is None:
+        import triton
+        import triton.language as tl
+
+        @triton.jit
+        def cosine_kernel(fw_ptr, ori_ptr, out_ptr, n_cols, BLOCK_SIZE: tl.constexpr):
+            # one program per layer; the dot product and both squared norms are accumulated in a single pass over
+            # the flattened update instead of three separate reduction kernels. The row offset is computed in int64:
+            # program_id and n_cols are i32, and row * n_cols overflows i32 for large updates (e.g. 8192^2 elements
+            # with a few dozen layers in the bucket).
+            row = tl.program_id(0).to(tl.int64)
+            fw_ptr += row * n_cols
+            ori_ptr += row * n_cols
+            dot = 0.0
+            norm_fw = 0.0
+            norm_ori = 0.0
+            for offset in range(0, n_cols, BLOCK_SIZE):
+                cols = offset + tl.arange(0, BLOCK_SIZE)
+                mask = cols < n_cols
+                fw = tl.load(fw_ptr + cols, mask=mask, other=0.0).to(tl.float32)
+                ori = tl.load(ori_ptr + cols, mask=mask, other=0.0).to(tl.float32)
+                dot += tl.sum(fw * ori)
+                norm_fw += tl.sum(fw * fw)
+                norm_ori += tl.sum(ori * ori)
+            cos = dot / (tl.sqrt(norm_fw) * tl.sqrt(norm_ori) + 1e-12)
+            tl.store(out_ptr + row, cos)
+
+        _triton_cosine_kernel = cosine_kernel
+    return _triton_cosine_kernel
+
+
+def _triton_cosine(fWs, oris):
+    kernel = _get_triton_cosine_kernel()
+    out = torch.empty(fWs.size(0), dtype=torch.float32, device=fWs.device)
+    kernel[(fWs.size(0),)](fWs, oris, out, fWs[0].numel(), BLOCK_SIZE=1024)
+    return out.to(fWs.dtype)
+
+
+_numba_project_layer = None
+
+
+def _get_numba_project_layer():
+    # compiled lazily so that importing this module never requires numba
+    global _numba_project_layer
+    if _numba_project_layer is None:
+        from numba import njit
+
+        @njit(parallel=True, cache=True, fastmath=True)
+        def project_layer(P, B, A):
+            W = P @ B
+            fW = W @ A
+            ori = B @ A
+            num = (fW * ori).sum()
+            den = np.sqrt((fW * fW).sum()) * np.sqrt((ori * ori).sum()) + 1e-12
+            return W, num / den
+
+        _numba_project_layer = project_layer
+    return _numba_project_layer
+
+
+def _compute_candidates(safelora_config, peft_weights, v):
+    """
+    Compute the projected lora_B candidate for every layer together with the cosine similarity between the projected
+    and the original LoRA update. No thresholding happens here, so the (expensive) matmuls only ever run once.
+    """
+    # a shallow copy is enough: peft_weights entries are only ever rebound to new tensors, never mutated in place
+    ori_peft_weights = dict(peft_weights)
     vars_names_LoRA_A = [name for name in peft_weights.keys() if "lora_A" in name]
     vars_names_LoRA_B = [name for name in peft_weights.keys() if "lora_B" in name]
-    num_projected_layers = 0
-    dis = []
-    cos_total = []
+
+    # on CPU, a jitted kernel that fuses the three products and the cosine of each layer into one call avoids the
+    # per-op dispatch overhead that dominates for small LoRA ranks
+    if (
+        torch.device(safelora_config.device).type == "cpu"
+        and safelora_config.dtype in (torch.float32, torch.float64)
+        and not safelora_config.quantize_projection
+        and is_numba_available()
+    ):
+        project_layer = _get_numba_project_layer()
+        candidates = {}
+        cos_total = []
+        for idx, (name_A, name_B) in enumerate(zip(vars_names_LoRA_A, vars_names_LoRA_B)):
+            P = np.ascontiguousarray(v[idx].to(safelora_config.dtype).numpy())
+            A = np.ascontiguousarray(ori_peft_weights[name_A].numpy())
+            B = np.ascontiguousarray(ori_peft_weights[name_B].numpy())
+            W, cos = project_layer(P, B, A)
+            candidates[name_B] = torch.from_numpy(W)
+            cos_total.append(float(cos))
+        return candidates, cos_total
+
+    # Bucket the layers by shape so that the three products (projected B, projected update, original update) each run
+    # as one torch.bmm per bucket instead of one kernel launch per layer and product.
+    buckets: dict[tuple, list[int]] = {}
     for idx, (name_A, name_B) in enumerate(zip(vars_names_LoRA_A, vars_names_LoRA_B)):
-        A = ori_peft_weights[name_A]
-        P = v[idx].to(safelora_config.dtype).to(safelora_config.device)
-        W = torch.mm(P, ori_peft_weights[name_B])
-        fW = torch.mm(W, A)
-        ori = torch.mm(ori_peft_weights[name_B], A)
-        cos = torch.nn.functional.cosine_similarity(fW.reshape(1, -1), ori.reshape(1, -1))
-        cos_total.append(cos.item())
-        if cos <= safelora_config.threshold:
-            num_projected_layers += 1
-            peft_weights[name_B] = W
+        key = (v[idx].shape, peft_weights[name_B].shape, peft_weights[name_A].shape)
+        buckets.setdefault(key, []).append(idx)
+
+    device_type = torch.device(safelora_config.device).type
+    # on CUDA, a fused triton kernel computes the dot product and both norms in one pass over memory; on CPU,
+    # SimSIMD's SIMD cosine kernel beats the generic torch reduction for the long flattened vectors
+    use_triton = device_type == "cuda" and is_triton_available()
+    use_simsimd = (
+        device_type == "cpu" and safelora_config.dtype in (torch.float32, torch.float64) and is_simsimd_available()
+    )
+    candidates = {}
+    bucket_cos = []
+    for indices in buckets.values():
+        Ps = torch.stack([v[idx].to(safelora_config.dtype).to(safelora_config.device) for idx in indices])
+        As = torch.stack([ori_peft_weights[vars_names_LoRA_A[idx]] for idx in indices])
+        Bs = torch.stack([ori_peft_weights[vars_names_LoRA_B[idx]] for idx in indices])
+        if safelora_config.quantize_projection:
+            try:
+                Ws = torch.stack([_int8_mm(Ps[pos], Bs[pos]) for pos in range(len(indices))])
+            except RuntimeError:
+                # torch._int_mm has minimum-size constraints that small LoRA ranks can violate
+                Ws = torch.bmm(Ps, Bs)
+        else:
+            Ws = torch.bmm(Ps, Bs)
+        fWs = torch.bmm(Ws, As)
+        oris = torch.bmm(Bs, As)
+        if use_triton:
+            bucket_cos.append(_triton_cosine(fWs, oris))
+        elif use_simsimd:
+            import simsimd
+
+            cos = torch.tensor(
+                [1.0 - float(simsimd.cosine(fW.ravel(), ori.ravel())) for fW, ori in zip(fWs.numpy(), oris.numpy())],
+                dtype=safelora_config.dtype,
+            )
+            bucket_cos.append(cos)
         else:
-            peft_weights[name_B] = ori_peft_weights[name_B]
+            # reduce over the matrices directly; no flattened intermediates are needed
+            num = (fWs * oris).sum(dim=(1, 2))
+            den = torch.linalg.vector_norm(fWs, dim=(1, 2)) * torch.linalg.vector_norm(oris, dim=(1, 2)) + 1e-12
+            bucket_cos.append(num / den)
+        for pos, idx in enumerate(indices):
+            candidates[vars_names_LoRA_B[idx]] = Ws[pos]
+
+    # a single device-to-host transfer for all cosine similarities, instead of one sync per bucket
+    cos_total = [None] * len(vars_names_LoRA_A)
+    flat_indices = [idx for indices in buckets.values() for idx in indices]
+    if flat_indices:
+        for idx, value in zip(flat_indices, torch.cat(bucket_cos).cpu().tolist()):
+            cos_total[idx] = value
+    return candidates, cos_total
+
+
+def _select_and_apply(safelora_config, peft_weights, candidates, cos_total):
+    """Replace the lora_B weights whose cosine similarity is at most the threshold with their projected candidates."""
+    vars_names_LoRA_B = [name for name in peft_weights.keys() if "lora_B" in name]
+    for name_B, cos in zip(vars_names_LoRA_B, cos_total):
+        if cos <= safelora_config.threshold:
+            peft_weights[name_B] = candidates[name_B]
+    return peft_weights
 
-        dist = 1 / (1 + torch.norm(peft_weights[name_B].reshape(1, -1) - W.reshape(1, -1)))
 
-        dis.append(dist.item())
-    return peft_weights, cos_total
+def project_weights(safelora_config, peft_weights, v):
+    candidates, cos_total = _compute_candidates(safelora_config, peft_weights, v)
+    return _select_and_apply(safelora_config, peft_weights, candidates, cos_total), cos_total
 
 
 def apply_safelora(safelora_config: SafeLoraConfig):
@@ -233,24 +464,44 @@ def apply_safelora(safelora_config: SafeLoraConfig):
         safelora_config.base_model_path, safelora_config.aligned_model_path, peft_config, safelora_config
     )
 
-    with safe_open(
-        f"{os.path.join(safelora_config.peft_model_path, peft.utils.constants.SAFETENSORS_WEIGHTS_NAME)}",
-        framework="pt",
-        device=safelora_config.device,
-    ) as f:
-        peft_weights = {name: f.get_tensor(name).to(safelora_config.dtype) for name in f.keys()}
+    # Always read the adapter to CPU first; loading with device="cuda" makes safetensors page in the file during the
+    # copy itself, serializing I/O. Pinning the CPU tensors lets the transfers below run as async DMA instead. Only
+    # the lora_A/lora_B tensors are materialized here: they are the only ones the projection consumes, and thanks to
+    # safetensors' offset-indexed layout the remaining tensors are never paged in.
+    is_cuda = torch.device(safelora_config.device).type == "cuda"
+    peft_weights_path = os.path.join(safelora_config.peft_model_path, peft.utils.constants.SAFETENSORS_WEIGHTS_NAME)
+    with safe_open(peft_weights_path, framework="pt", device="cpu") as f:
+        all_names = list(f.keys())
+        lora_names = [name for name in all_names if ("lora_A" in name) or ("lora_B" in name)]
+        peft_weights = {}
+        for name in lora_names:
+            tensor = f.get_tensor(name)
+            if is_cuda:
+                tensor = tensor.pin_memory()
+            peft_weights[name] = tensor.to(
+                device=safelora_config.device, dtype=safelora_config.dtype, non_blocking=True
+            )
+    if is_cuda:
+        torch.cuda.synchronize()
+    candidates, cos = _compute_candidates(safelora_config, peft_weights, projected_matrix)
     if safelora_config.select_layers_type == "threshold":
-        final_weights, _ = project_weights(safelora_config, peft_weights, projected_matrix)
+        final_weights = _select_and_apply(safelora_config, peft_weights, candidates, cos)
     elif safelora_config.select_layers_type == "number":
-        _, cos = project_weights(safelora_config, peft_weights, projected_matrix)
-        thrs = torch.sort(torch.Tensor(cos))[0][: safelora_config.num_proj_layers][-1]
+        # introselect the num_proj_layers-th smallest cosine in O(n) instead of sorting the whole array
+        k = min(safelora_config.num_proj_layers, len(cos)) - 1
+        thrs = float(np.partition(np.asarray(cos), k)[k])
         safelora_config.threshold = thrs
-        final_weights, _ = project_weights(safelora_config, peft_weights, projected_matrix)
+        final_weights = _select_and_apply(safelora_config, peft_weights, candidates, cos)
+
+    # tensors the projection never touches (e.g. modules_to_save) are read back on CPU and carried through, so that
+    # neither the saved file nor the returned dict loses them
+    other_names = [name for name in all_names if name not in peft_weights]
+    if other_names:
+        with safe_open(peft_weights_path, framework="pt", device="cpu") as f:
+            for name in other_names:
+                final_weights[name] = f.get_tensor(name).to(safelora_config.dtype)
 
     if safelora_config.save_weights:
-        save_file(
-            final_weights,
-            f"{os.path.join(safelora_config.peft_model_path, peft.utils.constants.SAFETENSORS_WEIGHTS_NAME)}",
-        )
+        save_file(final_weights, peft_weights_path)
 
     return final_weights
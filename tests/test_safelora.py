@@ -0,0 +1,242 @@
+# Copyright 2025-present the HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+import pytest
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from peft import LoraConfig
+from peft.utils.loftq_utils import _SafetensorLoader
+from peft.utils.safelora import SafeLoraConfig, apply_safelora, get_aligned_matrix
+
+
+HIDDEN = 16
+RANK = 4
+LAYERS = ["model.layers.0", "model.layers.1", "model.layers.2"]
+MODULES = ["self_attn.q_proj", "self_attn.v_proj"]
+
+
+def save_single_model(tensors, path):
+    os.makedirs(path)
+    save_file(tensors, os.path.join(path, "model.safetensors"))
+
+
+def save_sharded_model(tensors, path):
+    os.makedirs(path)
+    names = sorted(tensors)
+    half = len(names) // 2
+    shards = {
+        "model-00001-of-00002.safetensors": names[:half],
+        "model-00002-of-00002.safetensors": names[half:],
+    }
+    weight_map = {}
+    for file_name, keys in shards.items():
+        save_file({name: tensors[name] for name in keys}, os.path.join(path, file_name))
+        for name in keys:
+            weight_map[name] = file_name
+    with open(os.path.join(path, "model.safetensors.index.json"), "w") as f:
+        json.dump({"metadata": {"total_size": 0}, "weight_map": weight_map}, f)
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    """Create a sharded base model, a sharded aligned model and a LoRA adapter with deterministic random weights."""
+    torch.manual_seed(0)
+    base, aligned = {}, {}
+    for layer in LAYERS:
+        for module in MODULES:
+            name = f"{layer}.{module}.weight"
+            base[name] = torch.randn(HIDDEN, HIDDEN)
+            aligned[name] = base[name] + 0.1 * torch.randn(HIDDEN, HIDDEN)
+        # not a target module, must be ignored by the projection
+        base[f"{layer}.mlp.gate_proj.weight"] = torch.randn(HIDDEN, HIDDEN)
+        aligned[f"{layer}.mlp.gate_proj.weight"] = torch.randn(HIDDEN, HIDDEN)
+
+    save_sharded_model(base, str(tmp_path / "base"))
+    save_sharded_model(aligned, str(tmp_path / "aligned"))
+
+    adapter = {}
+    for layer in LAYERS:
+        for module in MODULES:
+            prefix = f"base_model.model.{layer}.{module}"
+            adapter[f"{prefix}.lora_A.weight"] = torch.randn(RANK, HIDDEN)
+            adapter[f"{prefix}.lora_B.weight"] = torch.randn(HIDDEN, RANK)
+    peft_dir = tmp_path / "peft"
+    LoraConfig(r=RANK, target_modules=["q_proj", "v_proj"], init_lora_weights=False).save_pretrained(peft_dir)
+    save_file(adapter, os.path.join(peft_dir, "adapter_model.safetensors"))
+
+    return {"tmp_path": tmp_path, "base": base, "aligned": aligned, "adapter": adapter}
+
+
+def get_safelora_config(workspace, **kwargs):
+    return SafeLoraConfig(
+        base_model_path=str(workspace["tmp_path"] / "base"),
+        aligned_model_path=str(workspace["tmp_path"] / "aligned"),
+        peft_model_path=str(workspace["tmp_path"] / "peft"),
+        device="cpu",
+        dtype=torch.float32,
+        local_files_only=True,
+        **kwargs,
+    )
+
+
+def reference_final_weights(workspace, threshold=None, num_proj_layers=None):
+    """Per-layer reference implementation of the SafeLoRA projection, following the paper's algorithm directly."""
+    target_names = sorted(name for name in workspace["base"] if ("q_proj" in name) or ("v_proj" in name))
+    projections = []
+    for name in target_names:
+        diff = workspace["base"][name] - workspace["aligned"][name]
+        projections.append(diff @ diff.T / torch.norm(diff))
+
+    adapter = workspace["adapter"]
+    names_A = sorted(name for name in adapter if "lora_A" in name)
+    names_B = sorted(name for name in adapter if "lora_B" in name)
+    candidates, cosines = {}, []
+    for idx, (name_A, name_B) in enumerate(zip(names_A, names_B)):
+        W = projections[idx] @ adapter[name_B]
+        fW = W @ adapter[name_A]
+        ori = adapter[name_B] @ adapter[name_A]
+        cos = torch.nn.functional.cosine_similarity(fW.reshape(1, -1), ori.reshape(1, -1)).item()
+        candidates[name_B] = W
+        cosines.append(cos)
+
+    if threshold is None:
+        threshold = sorted(cosines)[num_proj_layers - 1]
+    expected = dict(adapter)
+    for name_B, cos in zip(names_B, cosines):
+        if cos <= threshold:
+            expected[name_B] = candidates[name_B]
+    return expected
+
+
+class TestApplySafelora:
+    def test_threshold_selection_matches_reference(self, workspace):
+        # with the fixed seed the six cosines lie in [0.597, 0.719], so a threshold of 0.65 projects exactly 2 layers
+        config = get_safelora_config(workspace, select_layers_type="threshold", threshold=0.65, save_weights=False)
+        final_weights = apply_safelora(config)
+
+        expected = reference_final_weights(workspace, threshold=0.65)
+        assert set(final_weights) == set(expected)
+        num_projected = sum(
+            not torch.equal(final_weights[name], workspace["adapter"][name])
+            for name in final_weights
+            if "lora_B" in name
+        )
+        assert num_projected == 2
+        for name in expected:
+            assert torch.allclose(final_weights[name], expected[name], atol=1e-5)
+
+    def test_number_selection_matches_reference(self, workspace):
+        config = get_safelora_config(workspace, select_layers_type="number", num_proj_layers=3, save_weights=False)
+        final_weights = apply_safelora(config)
+
+        expected = reference_final_weights(workspace, num_proj_layers=3)
+        num_projected = sum(
+            not torch.equal(final_weights[name], workspace["adapter"][name])
+            for name in final_weights
+            if "lora_B" in name
+        )
+        assert num_projected == 3
+        for name in expected:
+            assert torch.allclose(final_weights[name], expected[name], atol=1e-5)
+
+    def test_save_weights_preserves_non_lora_tensors(self, workspace):
+        adapter_path = workspace["tmp_path"] / "peft" / "adapter_model.safetensors"
+        extra_name = "base_model.model.lm_head.modules_to_save.weight"
+        extra_tensor = torch.randn(8, 8)
+        tensors = dict(workspace["adapter"])
+        tensors[extra_name] = extra_tensor
+        save_file(tensors, str(adapter_path))
+
+        config = get_safelora_config(workspace, select_layers_type="number", num_proj_layers=3, save_weights=True)
+        final_weights = apply_safelora(config)
+
+        assert extra_name in final_weights
+        with safe_open(str(adapter_path), framework="pt", device="cpu") as f:
+            assert extra_name in f.keys()
+            assert torch.allclose(f.get_tensor(extra_name), extra_tensor)
+            # the saved lora weights are the projected ones
+            for name in final_weights:
+                assert torch.allclose(f.get_tensor(name), final_weights[name], atol=1e-5)
+
+    def test_aligned_matrix_matches_reference(self, workspace):
+        config = get_safelora_config(workspace)
+        peft_config = LoraConfig(r=RANK, target_modules=["q_proj", "v_proj"])
+        projections = get_aligned_matrix(config.base_model_path, config.aligned_model_path, peft_config, config)
+
+        target_names = sorted(name for name in workspace["base"] if ("q_proj" in name) or ("v_proj" in name))
+        assert len(projections) == len(target_names)
+        for name, projection in zip(target_names, projections):
+            diff = workspace["base"][name] - workspace["aligned"][name]
+            expected = diff @ diff.T / torch.norm(diff)
+            assert torch.allclose(projection, expected, atol=1e-5)
+
+    def test_empty_target_modules_raises(self, workspace):
+        config = get_safelora_config(workspace)
+        peft_config = LoraConfig(r=RANK, target_modules=[])
+        with pytest.raises(ValueError, match="no target module"):
+            get_aligned_matrix(config.base_model_path, config.aligned_model_path, peft_config, config)
+
+    def test_identical_base_and_aligned_model_raises(self, workspace):
+        save_sharded_model(workspace["base"], str(workspace["tmp_path"] / "base_copy"))
+        config = get_safelora_config(workspace, save_weights=False)
+        config.aligned_model_path = str(workspace["tmp_path"] / "base_copy")
+        with pytest.raises(ValueError, match="should be different"):
+            apply_safelora(config)
+
+
+class TestSafetensorLoader:
+    def test_single_file(self, workspace):
+        save_single_model(workspace["base"], str(workspace["tmp_path"] / "single"))
+        loader = _SafetensorLoader(str(workspace["tmp_path"] / "single"))
+
+        assert set(loader.weight_map) == set(workspace["base"])
+        name = "model.layers.0.self_attn.q_proj.weight"
+        assert torch.equal(loader.get_tensor(name), workspace["base"][name])
+
+    def test_sharded(self, workspace):
+        loader = _SafetensorLoader(str(workspace["tmp_path"] / "base"))
+
+        assert loader.is_sharded
+        assert set(loader.weight_map) == set(workspace["base"])
+        for name, tensor in workspace["base"].items():
+            assert torch.equal(loader.get_tensor(name), tensor)
+
+    def test_missing_key_raises(self, workspace):
+        save_single_model(workspace["base"], str(workspace["tmp_path"] / "single"))
+        loader = _SafetensorLoader(str(workspace["tmp_path"] / "single"))
+
+        with pytest.raises(KeyError, match="does-not-exist"):
+            loader.get_tensor("does-not-exist")
+
+    def test_base_model_prefix_is_stripped(self, workspace):
+        save_single_model(workspace["base"], str(workspace["tmp_path"] / "single"))
+        loader = _SafetensorLoader(str(workspace["tmp_path"] / "single"))
+        loader.base_model_prefix = "transformer"
+
+        name = "model.layers.0.self_attn.q_proj.weight"
+        assert torch.equal(loader.get_tensor(f"transformer.{name}"), workspace["base"][name])
+
+    def test_explicit_model_path(self, workspace):
+        save_single_model(workspace["base"], str(workspace["tmp_path"] / "single"))
+        # passing model_path directly must not require a peft model object
+        loader = _SafetensorLoader(None, model_path=str(workspace["tmp_path"] / "single" / "model.safetensors"))
+
+        assert loader.base_model_prefix is None
+        name = "model.layers.0.self_attn.q_proj.weight"
+        assert torch.equal(loader.get_tensor(name), workspace["base"][name])